@@ -1,43 +1,2253 @@
 #!/usr/bin/env python3
 import os
-from flask import Flask, request, jsonify
+import socket
+import threading
+import time
+import uuid
+from flask import Flask, Response, request, jsonify, g, stream_with_context
 from flask_cors import CORS
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import calendar
+import gc
+import hashlib
+import hmac
 import json
+import math
+import queue
+import random
+import re
+import sqlite3
+import sys
+import tracemalloc
+from datetime import datetime
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
-CORS(app)
-writemethods = {"eth_sendRawTransaction","eth_gasPrice"}
-readEndpoint = "http://127.0.0.1:8881"
+CORS(app, expose_headers=["X-Request-Id", "Server-Timing", "ETag"])
+# "unix:/path/to/socket" endpoints talk HTTP over a Unix domain socket
+readEndpoint = os.getenv("READ_RPC_ENDPOINT", "http://127.0.0.1:8881")
+# evm-rpc replicas that share the read load; with more than one, the head is tracked on the freshest of them
+readEndpoints = [e.strip() for e in os.getenv("READ_RPC_ENDPOINTS", readEndpoint).split(",") if e.strip()]
 writeEndpoint = os.getenv("WRITE_RPC_ENDPOINT", "http://127.0.0.1:18888")
+testEndpoint = os.getenv("TEST_RPC_ENDPOINT", "http://127.0.0.1:8882")
+nodeosEndpoint = os.getenv("NODEOS_RPC_ENDPOINT", "http://127.0.0.1:8888")
 flaskListenPort = os.getenv("FLASK_SERVER_PORT", 5000)
+flaskListenSocket = os.getenv("FLASK_SERVER_UNIX_SOCKET")
+# batches of at least this many elements are streamed back with chunked encoding
+streamBatchThreshold = int(os.getenv("STREAM_BATCH_THRESHOLD", 20))
+maxBatchResponseBytes = int(os.getenv("MAX_BATCH_RESPONSE_BYTES", 64 * 1024 * 1024))
+maxRequestBytes = int(os.getenv("MAX_REQUEST_BYTES", 8 * 1024 * 1024))
+maxBatchLength = int(os.getenv("MAX_BATCH_LENGTH", 10000))
+maxJsonDepth = int(os.getenv("MAX_JSON_DEPTH", 64))
+
+# Same classification as peripherals/proxy/eth-jsonrpc-access.lua. A "ns_*" entry
+# matches every method of that namespace.
+readCalls = os.getenv("JSONRPC_READ_CALLS", "net_version,net_listening,net_peerCount,web3_clientVersion,web3_sha3,"
+    "eth_blockNumber,eth_chainId,eth_protocolVersion,eth_syncing,eth_mining,eth_hashrate,eth_accounts,eth_feeHistory,eth_maxPriorityFeePerGas,"
+    "eth_getBlockByHash,eth_getBlockByNumber,eth_getBlockTransactionCountByHash,eth_getBlockTransactionCountByNumber,"
+    "eth_getUncleByBlockHashAndIndex,eth_getUncleByBlockNumberAndIndex,eth_getUncleCountByBlockHash,eth_getUncleCountByBlockNumber,"
+    "eth_getTransactionByHash,eth_getRawTransactionByHash,eth_getTransactionByBlockHashAndIndex,eth_getRawTransactionByBlockHashAndIndex,"
+    "eth_getTransactionByBlockNumberAndIndex,eth_getRawTransactionByBlockNumberAndIndex,eth_getTransactionReceipt,eth_getBlockReceipts,"
+    "eth_estimateGas,eth_getBalance,eth_getCode,eth_getTransactionCount,eth_getStorageAt,eth_call,eth_callBundle,eth_createAccessList,"
+    "eth_getLogs,debug_*,trace_*")
+writeCalls = os.getenv("JSONRPC_WRITE_CALLS", "eth_sendRawTransaction,eth_gasPrice")
+testCalls = os.getenv("JSONRPC_TEST_CALLS", "")
 
 import logging
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
+logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+proxyLog = logging.getLogger('flask_proxy')
+proxyLog.setLevel(os.getenv("PROXY_LOG_LEVEL", "INFO"))
+
+# Time spent opening upstream connections by the current thread. Reset before
+# every upstream call so keep-alive reuse shows up as a zero connect phase.
+connectTiming = threading.local()
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            connectTiming.seconds = getattr(connectTiming, "seconds", 0.0) + time.perf_counter() - start
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            connectTiming.seconds = getattr(connectTiming, "seconds", 0.0) + time.perf_counter() - start
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+class UnixHTTPConnection(TimedHTTPConnection):
+    def __init__(self, *args, socket_path=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+class UnixHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = UnixHTTPConnection
+
+class UnixAdapter(HTTPAdapter):
+    """Sends requests for "unix:/path/to/socket" URLs over that Unix domain socket."""
+
+    def __init__(self):
+        super().__init__()
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+
+    def get_connection(self, url, proxies=None):
+        path = url[len("unix:"):]
+        if path.startswith("//"):
+            path = path[2:]
+        with self.pools_lock:
+            pool = self.pools.get(path)
+            if pool is None:
+                pool = UnixHTTPConnectionPool("localhost", maxsize=self._pool_maxsize, socket_path=path)
+                self.pools[path] = pool
+        return pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.get_connection(request.url, proxies)
+
+    def request_url(self, request, proxies):
+        return "/"
+
+    def close(self):
+        with self.pools_lock:
+            for pool in self.pools.values():
+                pool.close()
+            self.pools.clear()
+        super().close()
+
+upstream = requests.Session()
+upstream.mount("http://", TimedAdapter())
+upstream.mount("https://", TimedAdapter())
+upstream.mount("unix:", UnixAdapter())
+
+safeMethodName = re.compile(r"[A-Za-z0-9_]{1,64}")
+
+def timing_desc(method):
+    # method names come from the client, only known and well-formed ones go into a header
+    if type(method) == str and safeMethodName.fullmatch(method) and route_of(method) is not None:
+        return method
+    return "other"
+
+class RequestTrace:
+    """Request id and per-phase timings of one proxied call, reported in the Server-Timing header."""
+
+    PHASES = ("queue", "parse", "upstream-connect", "upstream-wait", "serialize")
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(self.PHASES, 0.0)
+        self.elements = []
+        self.sizes = []
+        self.deadline = None
+        self.upstreams = []
+        self.receipt_held = False
+        self.etag = None
+
+    def set_budget(self, seconds):
+        self.deadline = self.started + seconds
+
+    def remaining(self):
+        return None if self.deadline is None else self.deadline - time.perf_counter()
+
+    def add(self, phase, seconds):
+        self.phases[phase] += seconds
+
+    def add_upstream(self, connect, wait):
+        self.add("upstream-connect", connect)
+        self.add("upstream-wait", wait)
+
+    def add_element(self, method, seconds):
+        self.elements.append((method, seconds))
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self, batch):
+        metrics = ["%s;dur=%.3f" % (phase, seconds * 1000) for phase, seconds in self.phases.items()]
+        if batch:
+            for i, (method, seconds) in enumerate(self.elements):
+                metrics.append('el%d;desc="%s";dur=%.3f' % (i, timing_desc(method), seconds * 1000))
+        return ", ".join(metrics)
+
+def build_dispatch():
+    # the Lua filter checks read, then write, then test calls; fill in reverse so the first match wins
+    table = {}
+    for route, calls in (("test", testCalls), ("write", writeCalls), ("read", readCalls)):
+        for method in calls.split(","):
+            method = method.strip()
+            if method:
+                table[method] = route
+    return table
+
+dispatch = build_dispatch()
+routeEndpoints = {"read": readEndpoint, "write": writeEndpoint, "test": testEndpoint}
+
+def lookup_method(table, method, default=None):
+    # exact name first, then the "ns_*" entry of the method's namespace
+    value = table.get(method)
+    if value is None and "_" in method:
+        value = table.get(method.split("_", 1)[0] + "_*")
+    return default if value is None else value
+
+def route_of(method):
+    return lookup_method(dispatch, method)
+
+def parse_method_table(spec, convert):
+    # "method=value,ns_*=value"
+    table = {}
+    for item in spec.split(","):
+        if "=" in item:
+            method, value = item.split("=", 1)
+            table[method.strip()] = convert(value.strip())
+    return table
+
+upstreamConnectTimeout = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 1))
+upstreamReadTimeout = float(os.getenv("UPSTREAM_READ_TIMEOUT", 10))
+methodReadTimeouts = parse_method_table(os.getenv("UPSTREAM_METHOD_TIMEOUTS", "eth_getLogs=30,debug_*=60,trace_*=60"), float)
+# remaining client budget in milliseconds, accepted from clients and passed on to upstreams
+deadlineHeader = "X-Request-Timeout-Ms"
+
+def jsonrpc_error(req, code, message):
+    return {"jsonrpc": "2.0", "id": req.get("id") if type(req) == dict else None, "error": {"code": code, "message": message}}
+
+class TrafficRecorder:
+    """Appends every proxied element to a JSONL file that flask_proxy_replay.py can play back.
+
+    Elements of one HTTP request share a seq number and timestamp so the
+    replayer can reassemble the original batch; the request_id comes from the
+    client and can repeat.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, "a", buffering=1)
+        self.seq = 0
+
+    def record(self, trace, client, batch, reqs):
+        ts = time.time() - trace.total()
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+        lines = []
+        for i, (req, size, (method, seconds)) in enumerate(zip(reqs, trace.sizes, trace.elements)):
+            lines.append(json.dumps({
+                "ts": round(ts, 6),
+                "seq": seq,
+                "request_id": trace.request_id,
+                "batch_index": i if batch else None,
+                "client": client,
+                "method": method,
+                "params": req.get("params") if type(req) == dict else None,
+                "response_size": size,
+                "latency_ms": round(seconds * 1000, 3),
+            }) + "\n")
+        with self.lock:
+            self.file.write("".join(lines))
+
+captureFile = os.getenv("CAPTURE_FILE")
+recorder = TrafficRecorder(captureFile) if captureFile else None
+
+def block_ref(value, head):
+    # block parameter as a number where it can be resolved, otherwise the tag, None when it is not a string
+    if value in ("latest", "pending") and head is not None:
+        return head
+    if type(value) != str:
+        return None
+    if value.startswith("0x"):
+        try:
+            return int(value, 16)
+        except ValueError:
+            pass
+    return value[:32]
+
+def short_str(value, length=80):
+    return value[:length] if type(value) == str else None
+
+def count_of(value):
+    return len(value) if type(value) == list else (0 if value is None else 1)
+
+def param_digest(method, params, head):
+    """Short summary of a call's params for the slow log, with the fields that say why a call was slow.
+
+    Params come straight from the client, so nothing about their types is assumed.
+    """
+    if type(params) != list:
+        params = [] if params is None else [params]
+    first = params[0] if params else None
+    if method == "eth_getLogs" and type(first) == dict:
+        if "blockHash" in first:
+            digest = {"blockHash": short_str(first["blockHash"])}
+        else:
+            start, end = block_ref(first.get("fromBlock", "latest"), head), block_ref(first.get("toBlock", "latest"), head)
+            digest = {"fromBlock": start, "toBlock": end}
+            if type(start) == int and type(end) == int:
+                digest["span"] = end - start + 1
+        digest["addresses"] = count_of(first.get("address"))
+        digest["topics"] = count_of(first.get("topics"))
+        return digest
+    if method in ("eth_call", "eth_estimateGas", "eth_createAccessList") and type(first) == dict:
+        data = first.get("data") or first.get("input")
+        return {"to": short_str(first.get("to")), "selector": short_str(data, 10),
+            "block": block_ref(params[1], head) if len(params) > 1 else None}
+    encoded = json.dumps(params, separators=(",", ":"))
+    return {"hash": hashlib.blake2b(encoded.encode(), digest_size=8).hexdigest(), "params": encoded[:120]}
+
+class SlowLog:
+    """Writes a JSON line for every call slower than its method's threshold.
+
+    At most rate entries per second are written, with bursts of up to one
+    second's worth; entries over the rate are only counted, and the count goes
+    out as "suppressed" with the next entry written. Batch elements are checked
+    one by one against their own time, with the request's phase timings.
+    """
+
+    def __init__(self, path, default_threshold, thresholds, rate):
+        self.default_threshold = default_threshold
+        self.thresholds = thresholds
+        self.rate = rate
+        self.tokens = rate
+        self.refilled = time.monotonic()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+        self.file = open(path, "a", buffering=1) if path else None
+
+    def allow(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return None
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+            return suppressed
+
+    def check(self, trace, batch, reqs, head):
+        # runs after the response is done, so a failure here must never reach the client
+        try:
+            self.check_elements(trace, batch, reqs, head)
+        except Exception:
+            proxyLog.exception("request_id=%s slow log entry failed", trace.request_id)
+
+    def check_elements(self, trace, batch, reqs, head):
+        for i, (method, seconds) in enumerate(trace.elements):
+            threshold = self.default_threshold if type(method) != str else lookup_method(self.thresholds, method, self.default_threshold)
+            if seconds < threshold:
+                continue
+            suppressed = self.allow()
+            if suppressed is None:
+                continue
+            params = reqs[i].get("params") if type(reqs[i]) == dict else None
+            entry = {"ts": time.time(), "request_id": trace.request_id, "method": short_str(method, 64), "ms": round(seconds * 1000, 3),
+                "threshold_ms": threshold * 1000, "params": param_digest(method, params, head),
+                "upstreams": sorted(set(trace.upstreams)), "response_bytes": trace.sizes[i] if i < len(trace.sizes) else None,
+                "phases_ms": {phase: round(s * 1000, 3) for phase, s in trace.phases.items()}}
+            if batch:
+                entry["batch_index"], entry["batch_length"] = i, len(reqs)
+            if suppressed:
+                entry["suppressed"] = suppressed
+            line = json.dumps(entry, separators=(",", ":"))
+            if self.file is not None:
+                self.file.write(line + "\n")
+            else:
+                proxyLog.warning("slow %s", line)
+
+# thresholds in milliseconds, SLOW_LOG_THRESHOLD_MS=0 disables the slow log
+slowThreshold = int(os.getenv("SLOW_LOG_THRESHOLD_MS", 1000)) / 1000
+slowLog = SlowLog(os.getenv("SLOW_LOG_FILE"), slowThreshold,
+    parse_method_table(os.getenv("SLOW_LOG_METHOD_THRESHOLDS_MS", "eth_getLogs=3000,debug_*=10000,trace_*=10000"), lambda ms: int(ms) / 1000),
+    float(os.getenv("SLOW_LOG_RATE", 10))) if slowThreshold > 0 else None
+
+class RequestRejected(Exception):
+    def __init__(self, status, message, code=-32600):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+
+class DeadlineExceeded(Exception):
+    pass
+
+class BoundedJsonReader:
+    """Scans a JSON body chunk by chunk and raises RequestRejected as soon as a limit is crossed.
+
+    Only structural characters are looked at, string contents are skipped with
+    one regex search per string, so the scan stays cheap next to json.loads.
+    """
+
+    STRUCTURAL = re.compile(rb'[\[\]{},"]')
+    STRING_END = re.compile(rb'["\\]')
+
+    def __init__(self, max_bytes, max_batch, max_depth):
+        self.max_bytes = max_bytes
+        self.max_batch = max_batch
+        self.max_depth = max_depth
+        self.size = 0
+        self.depth = 0
+        self.batch = None
+        self.separators = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise RequestRejected(413, "request body larger than %d bytes" % self.max_bytes)
+        pos = 0
+        while pos < len(chunk):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                    pos += 1
+                    continue
+                m = self.STRING_END.search(chunk, pos)
+                if m is None:
+                    return
+                if m.group() == b'"':
+                    self.in_string = False
+                else:
+                    self.escaped = True
+                pos = m.end()
+                continue
+            m = self.STRUCTURAL.search(chunk, pos)
+            if m is None:
+                return
+            c = m.group()
+            pos = m.end()
+            if c == b'"':
+                self.in_string = True
+            elif c in b"[{":
+                if self.batch is None:
+                    self.batch = c == b"["
+                self.depth += 1
+                if self.depth > self.max_depth:
+                    raise RequestRejected(400, "request nested deeper than %d" % self.max_depth)
+            elif c in b"]}":
+                self.depth -= 1
+            elif self.batch and self.depth == 1:
+                self.separators += 1
+                if self.separators + 1 > self.max_batch:
+                    raise RequestRejected(400, "batch longer than %d elements" % self.max_batch)
+
+def read_json_body():
+    if request.content_length is not None and request.content_length > maxRequestBytes:
+        raise RequestRejected(413, "request body larger than %d bytes" % maxRequestBytes)
+    reader = BoundedJsonReader(maxRequestBytes, maxBatchLength, maxJsonDepth)
+    chunks = []
+    while True:
+        chunk = request.stream.read(64 * 1024)
+        if not chunk:
+            break
+        reader.feed(chunk)
+        chunks.append(chunk)
+    try:
+        return json.loads(b"".join(chunks))
+    except ValueError:
+        raise RequestRejected(400, "invalid JSON request", -32700)
+
+def queue_time():
+    # nginx style "t=<epoch seconds>" set by a fronting load balancer
+    start = request.headers.get("X-Request-Start", "")
+    try:
+        start = float(start[2:] if start.startswith("t=") else start)
+    except ValueError:
+        return 0.0
+    return max(0.0, time.time() - start)
+
+def read_timeout(req):
+    method = req.get("method") if type(req) == dict else None
+    return lookup_method(methodReadTimeouts, method, upstreamReadTimeout) if type(method) == str else upstreamReadTimeout
+
+def upstream_timeout(req, trace):
+    # a batch body waits as long as its slowest kind of call may take
+    read = max(map(read_timeout, req), default=upstreamReadTimeout) if type(req) == list else read_timeout(req)
+    remaining = trace.remaining() if trace is not None else None
+    if remaining is not None:
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        return (min(upstreamConnectTimeout, remaining), min(read, remaining)), remaining
+    return (upstreamConnectTimeout, read), None
+
+def post_upstream(endpoint, req, trace=None):
+    # trace is None for the proxy's own background calls
+    headers = {"Accept":"application/json","Content-Type":"application/json"}
+    timeout, remaining = upstream_timeout(req, trace)
+    if trace is not None:
+        headers["X-Request-Id"] = trace.request_id
+        trace.upstreams.append(endpoint)
+    if remaining is not None:
+        headers[deadlineHeader] = str(int(remaining * 1000))
+    connectTiming.seconds = 0.0
+    start = time.perf_counter()
+    try:
+        resp = upstream.post(endpoint, json.dumps(req), headers=headers, timeout=timeout)
+    except requests.Timeout:
+        if remaining is not None and trace.remaining() <= 0:
+            raise DeadlineExceeded()
+        raise
+    elapsed = time.perf_counter() - start
+    if trace is not None:
+        trace.add_upstream(connectTiming.seconds, elapsed - connectTiming.seconds)
+    start = time.perf_counter()
+    resp = resp.json()
+    if trace is not None:
+        trace.add("parse", time.perf_counter() - start)
+    return resp
+
+def rpc_call(endpoint, method, params):
+    return post_upstream(endpoint, {"jsonrpc": "2.0", "id": 0, "method": method, "params": params})
+
+class HeadTracker:
+    """Polls evm-rpc for the latest block and notifies listeners when the head moves.
+
+    Listeners are called as listener(block, previous, forked) from the polling
+    thread; forked is set when the new head does not extend the previous one.
+    The hashes of the last depth canonical blocks are kept and, like
+    block-monitor.js, a new head is walked back through parentHash until it
+    meets them, so a fork is caught even when the head jumps several blocks.
+
+    With follow set, each poll asks the endpoint it returns instead of endpoint,
+    so the head follows the freshest replica rather than a fixed one.
+    """
+
+    def __init__(self, endpoint, interval, depth):
+        self.endpoint = endpoint
+        self.follow = None
+        self.interval = interval
+        self.depth = depth
+        self.head = None
+        self.hashes = OrderedDict()
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def number(self):
+        head = self.head
+        return int(head["number"], 16) if head is not None else None
+
+    def hash_at(self, number):
+        # canonical hash of a recent block, None when it is not tracked
+        return self.hashes.get(number)
+
+    def ancestry(self, endpoint, block):
+        """Returns (blocks, forked): the new blocks from the tracked chain up to block, oldest first."""
+        chain = [block]
+        while len(chain) <= self.depth:
+            parent = int(chain[-1]["number"], 16) - 1
+            known = self.hashes.get(parent)
+            if known == chain[-1]["parentHash"]:
+                # forked when tracked blocks above the common ancestor get replaced
+                return chain[::-1], parent < next(reversed(self.hashes))
+            if known is None and (not self.hashes or parent < next(iter(self.hashes))):
+                break
+            block = rpc_call(endpoint, "eth_getBlockByHash", [chain[-1]["parentHash"], False]).get("result")
+            if block is None:
+                break
+            chain.append(block)
+        # no common ancestor within reach, assume the worst
+        return chain[::-1], True
+
+    def poll(self):
+        endpoint = self.follow() if self.follow is not None else self.endpoint
+        block = rpc_call(endpoint, "eth_getBlockByNumber", ["latest", False]).get("result")
+        previous = self.head
+        if block is None or self.hashes.get(int(block["number"], 16)) == block["hash"]:
+            # unchanged, or a replica behind on the same chain
+            return
+        if previous is None:
+            chain, forked = [block], False
+        else:
+            chain, forked = self.ancestry(endpoint, block)
+        hashes = self.hashes.copy()
+        if forked:
+            first = int(chain[0]["number"], 16)
+            for number in [n for n in hashes if n >= first]:
+                del hashes[number]
+        for b in chain:
+            hashes[int(b["number"], 16)] = b["hash"]
+        while len(hashes) > self.depth:
+            hashes.popitem(last=False)
+        self.hashes = hashes
+        self.head = block
+        for listener in self.listeners:
+            try:
+                listener(block, previous, forked)
+            except Exception:
+                proxyLog.exception("head listener failed for block %s", block["number"])
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                proxyLog.warning("head tracker poll failed: %s", e)
+            time.sleep(self.interval)
+
+    def start(self):
+        threading.Thread(target=self.run, name="head-tracker", daemon=True).start()
+
+headTracker = HeadTracker(readEndpoint, int(os.getenv("HEAD_POLL_INTERVAL_MS", 500)) / 1000, int(os.getenv("HEAD_TRACKER_DEPTH", 1000)))
+
+class GasPriceCache:
+    """Caches the miner's eth_gasPrice answer for a short TTL.
+
+    A hit in the last part of the TTL refreshes the price in the background, so
+    steady traffic never waits for the miner. Misses are single-flight.
+    """
+
+    def __init__(self, endpoint, ttl, refresh_ahead=0.25):
+        self.endpoint = endpoint
+        self.ttl = ttl
+        self.refresh_ahead = ttl * refresh_ahead
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+        self.value = None
+        self.expires = 0.0
+        self.refreshing = False
+
+    def invalidate(self):
+        with self.lock:
+            self.value = None
+            self.expires = 0.0
+
+    def fetch(self, trace=None):
+        resp = post_upstream(self.endpoint, {"jsonrpc": "2.0", "id": 0, "method": "eth_gasPrice", "params": []}, trace)
+        if "result" in resp:
+            with self.lock:
+                self.value = resp["result"]
+                self.expires = time.monotonic() + self.ttl
+        return resp
+
+    def refresh(self):
+        try:
+            with self.fetch_lock:
+                self.fetch()
+        except Exception as e:
+            proxyLog.warning("gas price refresh failed: %s", e)
+        finally:
+            self.refreshing = False
+
+    def get(self, req, trace):
+        now = time.monotonic()
+        with self.lock:
+            value, expires = self.value, self.expires
+            if value is not None and now < expires and now > expires - self.refresh_ahead and not self.refreshing:
+                self.refreshing = True
+                threading.Thread(target=self.refresh, name="gas-price-refresh", daemon=True).start()
+        if value is None or now >= expires:
+            with self.fetch_lock:
+                with self.lock:
+                    value, expires = self.value, self.expires
+                if value is None or time.monotonic() >= expires:
+                    resp = self.fetch(trace)
+                    if "result" not in resp:
+                        return dict(resp, id=req.get("id"))
+                    value = resp["result"]
+        return {"jsonrpc": "2.0", "id": req.get("id"), "result": value}
+
+    def on_new_head(self, block, previous, forked):
+        # the price only moves with the contract config, which shows up in the base fee or in the EVM
+        # version evm-node carries in the nonce; mixHash is the native block id and changes every block
+        if previous is not None and (block.get("baseFeePerGas") != previous.get("baseFeePerGas") or block.get("nonce") != previous.get("nonce")):
+            self.invalidate()
+
+# position of the block parameter of the calls whose block tag is pinned to the tracked head
+blockTagParams = {"eth_call": 1, "eth_getBalance": 1, "eth_getCode": 1, "eth_getStorageAt": 2, "eth_getBlockByNumber": 0,
+    "eth_getBlockTransactionCountByNumber": 0, "eth_getTransactionByBlockNumberAndIndex": 0}
+pinBlockTags = os.getenv("PIN_BLOCK_TAGS", "1") == "1"
+
+def pin_block_tag(req, head, lib):
+    """Returns req with a "latest"/"pending" (or omitted) block tag replaced by the concrete head number.
+
+    "safe" and "finalized" are replaced by the EVM LIB when it is known.
+    """
+    pos = blockTagParams.get(req["method"])
+    params = req.get("params")
+    if pos is None or head is None or type(params) != list:
+        return req
+    if len(params) > pos:
+        if params[pos] in ("latest", "pending"):
+            pinned = head
+        elif params[pos] in ("safe", "finalized") and lib is not None:
+            pinned = lib
+        else:
+            return req
+        params = params[:pos] + [hex(pinned)] + params[pos + 1:]
+    elif len(params) == pos and pos > 0:
+        params = params + [hex(head)]
+    else:
+        return req
+    return dict(req, params=params)
+
+gasPriceTtl = float(os.getenv("GAS_PRICE_CACHE_TTL", 3))
+gasPriceCache = GasPriceCache(writeEndpoint, gasPriceTtl) if gasPriceTtl > 0 else None
+if gasPriceCache is not None:
+    headTracker.add_listener(gasPriceCache.on_new_head)
+
+def block_number_param(tag):
+    # canonical hex of a concrete block number, None for tags and hashes
+    if type(tag) != str or not tag.startswith("0x") or len(tag) > 18:
+        return None
+    try:
+        return hex(int(tag, 16))
+    except ValueError:
+        return None
+
+def convert_to_epoch(timestamp):
+    # nodeos block timestamps are UTC without a zone suffix, e.g. 2023-01-01T00:00:00.500
+    return calendar.timegm(datetime.strptime(timestamp.split(".")[0], "%Y-%m-%dT%H:%M:%S").timetuple())
+
+# native blocks come every 500ms, two per EVM block
+nativeBlockIntervalMs = 500
+
+def ends_second(timestamp):
+    # whether a native block with this timestamp is the last one of its second
+    millis = int((timestamp.split(".") + ["0"])[1][:3].ljust(3, "0"))
+    return millis + nativeBlockIntervalMs >= 1000
+
+class LibTracker:
+    """Follows the Antelope LIB and maps it to an EVM block number.
+
+    Same mapping as get_evm_lib() in eos-evm-ws-proxy's block monitor: the
+    timestamp of the LIB block is turned into an EVM block number through the
+    genesis timestamp, one EVM block per second. An EVM block takes in every
+    native block of its second, so unless the LIB block is the last one of its
+    second a fork can still change the EVM block it maps to; lib is then the
+    block before it, as in evm-node's block conversion.
+    """
+
+    def __init__(self, nodeos_endpoint, genesis_timestamp, interval):
+        self.nodeos_endpoint = nodeos_endpoint
+        self.genesis_timestamp = genesis_timestamp
+        self.interval = interval
+        self.lib = None
+        self.head_time = None
+
+    def timestamp_to_evm_block_num(self, timestamp):
+        block_interval = 1
+        if timestamp < self.genesis_timestamp:
+            return 0
+        return 1 + (timestamp - self.genesis_timestamp) // block_interval
+
+    def nodeos_call(self, path, body):
+        return upstream.post(self.nodeos_endpoint + path, json.dumps(body), timeout=(upstreamConnectTimeout, upstreamReadTimeout)).json()
+
+    def poll(self):
+        if self.genesis_timestamp is None:
+            # without GENESIS_JSON the timestamp of EVM block 0 is the genesis timestamp
+            self.genesis_timestamp = int(rpc_call(readEndpoint, "eth_getBlockByNumber", ["0x0", False])["result"]["timestamp"], 16)
+        info = self.nodeos_call("/v1/chain/get_info", {})
+        self.head_time = convert_to_epoch(info["head_block_time"])
+        block = self.nodeos_call("/v1/chain/get_block", {"block_num_or_id": info["last_irreversible_block_num"]})
+        lib = self.timestamp_to_evm_block_num(convert_to_epoch(block["timestamp"]))
+        if not ends_second(block["timestamp"]):
+            lib = max(lib - 1, 0)
+        if self.lib is None or lib > self.lib:
+            self.lib = lib
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                proxyLog.warning("LIB poll failed: %s", e)
+            time.sleep(self.interval)
+
+    def start(self):
+        threading.Thread(target=self.run, name="lib-tracker", daemon=True).start()
+
+def load_genesis_timestamp(path):
+    if not path:
+        return None
+    with open(path) as f:
+        return int(json.load(f)["timestamp"], 16)
+
+libTracker = LibTracker(nodeosEndpoint, load_genesis_timestamp(os.getenv("GENESIS_JSON")), int(os.getenv("LIB_POLL_INTERVAL_MS", 2000)) / 1000)
+
+# position of the block parameter of state queries that can be cached once pinned to a block
+stateBlockParams = {"eth_call": 1, "eth_estimateGas": 1, "eth_getBalance": 1, "eth_getCode": 1, "eth_getStorageAt": 2, "eth_getTransactionCount": 1}
+callQuantityFields = {"gas", "gasPrice", "maxFeePerGas", "maxPriorityFeePerGas", "value", "nonce", "type", "chainId"}
+
+def canonical(params):
+    return json.dumps(params, separators=(",", ":"), sort_keys=True)
+
+def quantity_param(value):
+    # canonical hex of any 0x quantity, None if it is not one
+    if type(value) != str or not value.startswith("0x"):
+        return None
+    try:
+        return hex(int(value, 16))
+    except ValueError:
+        return None
+
+def normalize_block_ref(ref):
+    """Returns (canonical ref, block number) for a block number, block hash or EIP-1898 object.
+
+    The number is None for a hash, the state at a given hash never changes.
+    Anything else, including hashes with requireCanonical, gives (None, None).
+    """
+    if type(ref) == dict:
+        if "blockNumber" in ref and len(ref) == 1:
+            ref = ref["blockNumber"]
+        elif "blockHash" in ref and not ref.get("requireCanonical"):
+            ref = ref["blockHash"]
+        else:
+            return None, None
+    if type(ref) != str:
+        return None, None
+    if len(ref) == 66:
+        return ("0x" + ref[2:].lower(), None) if quantity_param(ref) is not None else (None, None)
+    tag = block_number_param(ref)
+    return (tag, int(tag, 16)) if tag is not None else (None, None)
+
+def normalize_call(call):
+    """Canonical form of an eth_call/eth_estimateGas call object.
+
+    Addresses and data are lower-cased, quantities lose their zero padding,
+    "data" becomes "input", and zero value or empty input is dropped since
+    that is what omitting them means.
+    """
+    if type(call) != dict:
+        return None
+    out = {}
+    for field, value in call.items():
+        if value is None:
+            continue
+        if field in callQuantityFields:
+            value = quantity_param(value)
+            if value is None:
+                return None
+        elif field == "data":
+            field = "input"
+        if type(value) == str:
+            value = value.lower()
+        elif field != "accessList":
+            return None
+        if field in out and out[field] != value:
+            return None
+        out[field] = value
+    if out.get("value") == "0x0":
+        del out["value"]
+    if out.get("input") == "0x":
+        del out["input"]
+    return out
+
+def normalize_state_params(method, params):
+    pos = stateBlockParams[method]
+    if len(params) != pos + 1:
+        return None, None
+    ref, number = normalize_block_ref(params[pos])
+    if ref is None:
+        return None, None
+    if method in ("eth_call", "eth_estimateGas"):
+        head = [normalize_call(params[0])]
+    elif type(params[0]) == str:
+        head = [params[0].lower()]
+        if method == "eth_getStorageAt":
+            head.append(quantity_param(params[1]))
+    else:
+        return None, None
+    if None in head:
+        return None, None
+    return head + [ref], number
+
+def cache_key(req):
+    """Returns (key, block number) for a cacheable call pinned to a concrete block, or (None, None).
+
+    For log ranges the block number is the end of the range. State queries
+    pinned to a block hash return a key with block number None.
+    """
+    method = req["method"]
+    params = req.get("params")
+    if type(params) != list or not params:
+        return None, None
+    if method == "eth_getBlockByNumber" and len(params) == 2:
+        tag = block_number_param(params[0])
+        params = [tag, bool(params[1])]
+    elif method == "eth_getBlockReceipts" and len(params) == 1:
+        tag = block_number_param(params[0])
+        params = [tag]
+    elif method == "eth_getLogs" and len(params) == 1 and type(params[0]) == dict and "blockHash" not in params[0]:
+        first, tag = block_number_param(params[0].get("fromBlock")), block_number_param(params[0].get("toBlock"))
+        if first is None or tag is None:
+            return None, None
+        params = [dict(params[0], fromBlock=first, toBlock=tag)]
+    elif method in stateBlockParams:
+        params, number = normalize_state_params(method, params)
+        return (None, None) if params is None else (method + canonical(params), number)
+    else:
+        return None, None
+    if tag is None:
+        return None, None
+    return method + canonical(params), int(tag, 16)
+
+class DiskCache:
+    """SQLite store behind the final tier of the response cache, so it survives restarts.
+
+    Only results at or below LIB are written, they never change. The key index
+    and sizes are loaded into memory at startup, so a miss never touches the
+    database. Writes and last-use updates go through one writer thread; when
+    the stored results exceed max_bytes the least recently used ones are
+    deleted down to 90% of it.
+
+    The file records the chain it was written for, its chain id and the hash
+    of block 0. The writer thread checks that against the read endpoint before
+    the cache is used, and empties the file when it belongs to another chain,
+    for instance after a chain restart. Until then every lookup misses.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ready = False
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        if "etag" not in [row[1] for row in self.db.execute("PRAGMA table_info(entries)")]:
+            self.db.execute("ALTER TABLE entries ADD COLUMN etag TEXT")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.sizes = dict(self.db.execute("SELECT key, size FROM entries"))
+        self.total = sum(self.sizes.values())
+        self.writes = queue.Queue()
+        proxyLog.info("disk cache %s: %d entries, %d bytes", path, len(self.sizes), self.total)
+
+    def verify(self):
+        while True:
+            try:
+                chain_id = rpc_call(readEndpoint, "eth_chainId", [])["result"]
+                genesis = rpc_call(readEndpoint, "eth_getBlockByNumber", ["0x0", False])["result"]["hash"]
+                break
+            except Exception as e:
+                proxyLog.warning("disk cache waits for the chain identity: %s", e)
+                time.sleep(1)
+        chain = "%s:%s" % (int(chain_id, 16), genesis)
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'chain'").fetchone()
+            # files without a recorded chain cannot be trusted either
+            if (row is None and self.sizes) or (row is not None and row[0] != chain):
+                proxyLog.warning("disk cache %s was written for chain %s, now on %s: dropping %d entries",
+                    self.path, row[0] if row else "unknown", chain, len(self.sizes))
+                self.db.execute("DELETE FROM entries")
+                self.sizes = {}
+                self.total = 0
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('chain', ?)", (chain,))
+            self.db.commit()
+        self.ready = True
+
+    def get(self, key):
+        if not self.ready or key not in self.sizes:
+            return ResponseCache.MISS
+        with self.lock:
+            row = self.db.execute("SELECT value, etag FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return ResponseCache.MISS
+        self.writes.put(("touch", key, None))
+        value = bytes(row[0])
+        # rows written before the etag column existed
+        return value, row[1] or result_etag(value)
+
+    def put(self, key, encoded, etag):
+        if self.ready and key not in self.sizes:
+            self.writes.put(("put", key, (encoded, etag)))
+
+    def write(self, op, key, value, now):
+        if op == "touch":
+            self.db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (now, key))
+        elif key not in self.sizes:
+            encoded, etag = value
+            self.db.execute("INSERT OR REPLACE INTO entries (key, value, size, last_used, etag) VALUES (?, ?, ?, ?, ?)",
+                (key, encoded, len(encoded), now, etag))
+            self.sizes[key] = len(encoded)
+            self.total += len(encoded)
+
+    def evict(self):
+        target = self.max_bytes * 9 // 10
+        while self.total > target:
+            rows = self.db.execute("SELECT key, size FROM entries ORDER BY last_used LIMIT 1000").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.total <= target:
+                    break
+                self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.sizes.pop(key, None)
+                self.total -= size
+
+    def run(self):
+        self.verify()
+        while True:
+            ops = [self.writes.get()]
+            while not self.writes.empty() and len(ops) < 1000:
+                ops.append(self.writes.get())
+            try:
+                with self.lock:
+                    now = time.time()
+                    for op, key, value in ops:
+                        self.write(op, key, value, now)
+                    if self.total > self.max_bytes:
+                        self.evict()
+                    self.db.commit()
+            except sqlite3.Error as e:
+                proxyLog.warning("disk cache write failed: %s", e)
+
+    def start(self):
+        threading.Thread(target=self.run, name="disk-cache", daemon=True).start()
+
+def encode_result(result):
+    return json.dumps(result, separators=(",", ":")).encode()
+
+def result_etag(encoded_result):
+    return 'W/"%s"' % hashlib.blake2b(encoded_result, digest_size=16).hexdigest()
+
+def envelope(req_id, encoded_result):
+    """A complete JSON-RPC response around an already encoded result, no serialization of the result."""
+    return b"".join((b'{"jsonrpc":"2.0","id":', json.dumps(req_id).encode(), b',"result":', encoded_result, b'}'))
+
+class ResponseCache:
+    """Two-tier LRU of read results for calls pinned to a concrete block.
+
+    Results are stored as the UTF-8 JSON encoding of the "result" member, a hit
+    is answered by wrapping it with envelope().
+
+    Results for blocks at or below the EVM LIB can no longer change and go to
+    the final tier, which has no TTL. Everything above LIB lives in the
+    reversible tier: entries expire after ttl seconds and the whole tier is
+    dropped when a fork is seen. Reversible entries that fall below LIB are
+    promoted when they are hit, but only if their block is still the canonical
+    one the head tracker saw when they were stored. With a DiskCache, final
+    results are also kept on disk and promoted back to memory when hit there.
+    """
+
+    MISS = object()
+
+    def __init__(self, max_entries, ttl, max_final_entries, lib_tracker, head_tracker, disk=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_final_entries = max_final_entries
+        self.lib_tracker = lib_tracker
+        self.head_tracker = head_tracker
+        self.disk = disk
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.final = OrderedDict()
+
+    def is_final(self, number):
+        # number is None for results pinned to a block hash, those cannot change either
+        lib = self.lib_tracker.lib
+        return number is None or (lib is not None and number <= lib)
+
+    def put_final(self, key, result, persist=True):
+        if persist and self.disk is not None:
+            self.disk.put(key, *result)
+        self.final[key] = result
+        self.final.move_to_end(key)
+        while len(self.final) > self.max_final_entries:
+            self.final.popitem(last=False)
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            result = self.final.get(key, self.MISS)
+            if result is not self.MISS:
+                self.final.move_to_end(key)
+                return result
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self.entries[key]
+                entry = None
+            if entry is not None and self.is_final(entry[2]):
+                del self.entries[key]
+                if entry[3] is None or self.head_tracker.hash_at(entry[2]) != entry[3]:
+                    # stored for a block that is no longer (or not known to be) canonical
+                    return self.MISS
+                self.put_final(key, entry[1])
+                return entry[1]
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry[1]
+        if self.disk is None:
+            return self.MISS
+        result = self.disk.get(key)
+        if result is not self.MISS:
+            with self.lock:
+                self.put_final(key, result, persist=False)
+        return result
+
+    def put(self, key, result, number):
+        """Stores result and returns (encoding, ETag).
+
+        Hits return the same pair, so the ETag of a cached result is hashed once.
+        """
+        encoded = encode_result(result)
+        result = (encoded, result_etag(encoded))
+        with self.lock:
+            if self.is_final(number):
+                self.entries.pop(key, None)
+                self.put_final(key, result)
+                return result
+            self.entries[key] = (time.monotonic() + self.ttl, result, number, self.head_tracker.hash_at(number))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return result
+
+    def clear(self):
+        # only the reversible tier, final results survive forks
+        with self.lock:
+            self.entries.clear()
+
+    def on_new_head(self, block, previous, forked):
+        if forked:
+            proxyLog.info("fork at block %s, clearing reversible response cache", block["number"])
+            self.clear()
+
+cacheTtl = float(os.getenv("CACHE_TTL", 60))
+responseCache = None
+if cacheTtl > 0:
+    diskCachePath = os.getenv("DISK_CACHE_PATH")
+    diskCache = DiskCache(diskCachePath, int(os.getenv("DISK_CACHE_MAX_BYTES", 1024 * 1024 * 1024))) if diskCachePath else None
+    responseCache = ResponseCache(int(os.getenv("CACHE_MAX_ENTRIES", 10000)), cacheTtl, int(os.getenv("FINAL_CACHE_MAX_ENTRIES", 100000)), libTracker, headTracker, diskCache)
+    headTracker.add_listener(responseCache.on_new_head)
+
+class BlockIndex:
+    """Answers other shapes of the same data from full blocks (eth_getBlockByNumber(N, true)) seen by the cache.
+
+    Transactions by hash or by block and index, transaction counts and
+    hashes-only blocks are all derived from the full block without an upstream
+    call. Blocks above LIB are dropped on a fork, like the reversible cache
+    tier, and whenever a new block does not link up with its indexed
+    neighbours through parentHash. A block whose hash differs from the head
+    tracker's canonical one is not indexed at all.
+    """
+
+    MISS = ResponseCache.MISS
+
+    def __init__(self, max_blocks, lib_tracker, head_tracker):
+        self.max_blocks = max_blocks
+        self.lib_tracker = lib_tracker
+        self.head_tracker = head_tracker
+        self.lock = threading.Lock()
+        self.blocks = OrderedDict()
+        self.by_hash = {}
+        self.txs = {}
+
+    def add(self, block):
+        if type(block) != dict or not all(type(tx) == dict for tx in block.get("transactions", [])):
+            return
+        number = int(block["number"], 16)
+        canonical = self.head_tracker.hash_at(number)
+        if canonical is not None and canonical != block["hash"]:
+            return
+        with self.lock:
+            parent, child = self.blocks.get(number - 1), self.blocks.get(number + 1)
+            if (parent is not None and parent["hash"] != block["parentHash"]) or (child is not None and child["parentHash"] != block["hash"]):
+                proxyLog.info("block %d does not link up with the indexed blocks, dropping reversible blocks", number)
+                self.remove_reversible()
+            if number in self.blocks:
+                self.remove(number)
+            self.blocks[number] = block
+            self.by_hash[block["hash"].lower()] = number
+            for i, tx in enumerate(block["transactions"]):
+                self.txs[tx["hash"].lower()] = (number, i)
+            while len(self.blocks) > self.max_blocks:
+                self.remove(next(iter(self.blocks)))
+
+    def remove(self, number):
+        block = self.blocks.pop(number)
+        self.by_hash.pop(block["hash"].lower(), None)
+        for tx in block["transactions"]:
+            if self.txs.get(tx["hash"].lower(), (None,))[0] == number:
+                del self.txs[tx["hash"].lower()]
+
+    def remove_reversible(self):
+        lib = self.lib_tracker.lib
+        for number in [n for n in self.blocks if lib is None or n > lib]:
+            self.remove(number)
+
+    def clear_reversible(self):
+        with self.lock:
+            self.remove_reversible()
+
+    def on_new_head(self, block, previous, forked):
+        if forked:
+            self.clear_reversible()
+
+    def find(self, method, param):
+        # the indexed block a call refers to through a number or a hash
+        if type(param) != str:
+            return None
+        if "Number" in method:
+            tag = block_number_param(param)
+            return None if tag is None else self.blocks.get(int(tag, 16))
+        number = self.by_hash.get(param.lower())
+        return None if number is None else self.blocks.get(number)
+
+    def answer(self, req):
+        method = req["method"]
+        params = req.get("params")
+        if type(params) != list or not params:
+            return self.MISS
+        with self.lock:
+            if method == "eth_getTransactionByHash":
+                if type(params[0]) != str or params[0].lower() not in self.txs:
+                    return self.MISS
+                number, i = self.txs[params[0].lower()]
+                return self.blocks[number]["transactions"][i]
+            if method in ("eth_getBlockByNumber", "eth_getBlockByHash") and len(params) == 2:
+                block = self.find(method, params[0])
+                if block is None:
+                    return self.MISS
+                return block if params[1] else dict(block, transactions=[tx["hash"] for tx in block["transactions"]])
+            if method in ("eth_getBlockTransactionCountByNumber", "eth_getBlockTransactionCountByHash"):
+                block = self.find(method, params[0])
+                return self.MISS if block is None else hex(len(block["transactions"]))
+            if method in ("eth_getTransactionByBlockNumberAndIndex", "eth_getTransactionByBlockHashAndIndex") and len(params) == 2:
+                block = self.find(method, params[0])
+                index = block_number_param(params[1])
+                if block is None or index is None:
+                    return self.MISS
+                index = int(index, 16)
+                return block["transactions"][index] if index < len(block["transactions"]) else None
+        return self.MISS
+
+blockIndex = None
+if responseCache is not None:
+    blockIndex = BlockIndex(int(os.getenv("BLOCK_INDEX_MAX_BLOCKS", 1000)), libTracker, headTracker)
+    headTracker.add_listener(blockIndex.on_new_head)
+
+class BlockPrefetcher:
+    """Warms the response cache with a new head block, its receipts and its logs.
+
+    Like getBlockWithLogs in eos-evm-ws-proxy's block monitor, the block and its
+    logs are fetched in one upstream batch and only cached when they agree. Logs
+    are also checked against the receipts, since evm-rpc can answer eth_getLogs
+    for the head block before it has indexed its logs.
+    """
+
+    def __init__(self, cache, max_blocks):
+        self.cache = cache
+        self.max_blocks = max_blocks
+        self.heads = queue.Queue()
+        self.last = None
+        self.last_hash = None
+
+    def on_new_head(self, block, previous, forked):
+        self.heads.put((int(block["number"], 16), forked))
+
+    def prefetch(self, number):
+        tag = hex(number)
+        calls = [
+            {"jsonrpc": "2.0", "id": 0, "method": "eth_getBlockByNumber", "params": [tag, True]},
+            {"jsonrpc": "2.0", "id": 1, "method": "eth_getBlockReceipts", "params": [tag]},
+            {"jsonrpc": "2.0", "id": 2, "method": "eth_getLogs", "params": [{"fromBlock": tag, "toBlock": tag}]},
+        ]
+        # a replica that has the block, the head may come from any of them
+        results = post_upstream(readReplicas.pick(number), calls)
+        if type(results) != list or len(results) != len(calls):
+            raise ValueError("invalid response to prefetch batch for block %d" % number)
+        results = {r.get("id"): r.get("result") for r in results}
+        block, receipts, logs = results.get(0), results.get(1), results.get(2)
+        if not block or not block.get("hash"):
+            return False
+        if self.last == number - 1 and self.last_hash is not None and block["parentHash"] != self.last_hash:
+            proxyLog.info("prefetched block %d does not extend %s, clearing response cache", number, self.last_hash)
+            self.cache.clear()
+            blockIndex.clear_reversible()
+        self.last, self.last_hash = number, block["hash"]
+        self.cache.put(cache_key(calls[0])[0], block, number)
+        blockIndex.add(block)
+        if type(receipts) == list and len(receipts) == len(block["transactions"]):
+            self.cache.put(cache_key(calls[1])[0], receipts, number)
+            if type(logs) == list and all(l.get("blockHash") == block["hash"] for l in logs) and \
+                    len(logs) == sum(len(r.get("logs", [])) for r in receipts):
+                self.cache.put(cache_key(calls[2])[0], logs, number)
+        return True
+
+    def run(self):
+        while True:
+            number, forked = self.heads.get()
+            while not self.heads.empty():
+                number, more_forked = self.heads.get()
+                forked = forked or more_forked
+            if forked or self.last is None or number <= self.last:
+                first = number
+            else:
+                first = max(self.last + 1, number - self.max_blocks + 1)
+            try:
+                for n in range(first, number + 1):
+                    if not self.prefetch(n):
+                        break
+            except Exception as e:
+                proxyLog.warning("prefetch of block %d failed: %s", number, e)
+
+    def start(self):
+        threading.Thread(target=self.run, name="block-prefetcher", daemon=True).start()
+
+prefetcher = None
+if responseCache is not None and os.getenv("PREFETCH_BLOCKS", "1") == "1":
+    prefetcher = BlockPrefetcher(responseCache, int(os.getenv("PREFETCH_MAX_BLOCKS", 4)))
+    headTracker.add_listener(prefetcher.on_new_head)
+
+class ReadReplicas:
+    """Round-robin over the evm-rpc replicas, with each replica's head polled in the background.
+
+    A replica whose head block timestamp trails the newest replica head or the
+    nodeos head (while its evm-node is reconnecting to SHiP, say) by more than
+    max_lag seconds is lagging. Calls pinned to a block go to the replicas that
+    already have it, others skip lagging replicas; when no replica qualifies
+    all of them take turns. Waiters for a replica to reach a block are woken
+    whenever any head moves.
+    """
+
+    def __init__(self, endpoints, interval, max_lag, lib_tracker):
+        self.endpoints = endpoints
+        self.interval = interval
+        self.max_lag = max_lag
+        self.lib_tracker = lib_tracker
+        self.heads = dict.fromkeys(endpoints)
+        self.times = dict.fromkeys(endpoints)
+        self.lagging = set()
+        self.next = 0
+        self.cond = threading.Condition()
+
+    def pick(self, number=None):
+        """Next replica for a call; number is the block the call is pinned to, None for latest-sensitive calls."""
+        with self.cond:
+            candidates = [] if number is None else [e for e in self.endpoints if self.heads[e] is not None and self.heads[e] >= number]
+            candidates = candidates or [e for e in self.endpoints if e not in self.lagging] or self.endpoints
+            endpoint = candidates[self.next % len(candidates)]
+            self.next += 1
+        return endpoint
+
+    def freshest(self):
+        # the most advanced replica that is not lagging, the head tracker follows it
+        with self.cond:
+            heads = [(h, e) for e, h in self.heads.items() if h is not None and e not in self.lagging]
+        return max(heads)[1] if heads else self.endpoints[0]
+
+    def highest(self):
+        # (endpoint, head) of the replica furthest ahead, unknown heads count as behind
+        with self.cond:
+            return max(self.heads.items(), key=lambda e: -1 if e[1] is None else e[1])
+
+    def wait_for_head_above(self, number, timeout):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                head = max((h for h in self.heads.values() if h is not None), default=None)
+                remaining = deadline - time.monotonic()
+                if (head is not None and head > number) or remaining <= 0:
+                    return head
+                self.cond.wait(remaining)
+
+    def update_lagging(self):
+        reference = max([t for t in self.times.values() if t is not None] + [self.lib_tracker.head_time or 0])
+        lagging = {e for e in self.endpoints if self.times[e] is None or reference - self.times[e] > self.max_lag}
+        for endpoint in lagging - self.lagging:
+            proxyLog.warning("replica %s is lagging, head %s", endpoint, self.heads[endpoint])
+        for endpoint in self.lagging - lagging:
+            proxyLog.info("replica %s caught up, head %s", endpoint, self.heads[endpoint])
+        self.lagging = lagging
+
+    def poll(self):
+        for endpoint in self.endpoints:
+            try:
+                block = rpc_call(endpoint, "eth_getBlockByNumber", ["latest", False])["result"]
+                head, timestamp = int(block["number"], 16), int(block["timestamp"], 16)
+            except Exception as e:
+                proxyLog.debug("head poll of %s failed: %s", endpoint, e)
+                head, timestamp = None, None
+            with self.cond:
+                self.times[endpoint] = timestamp
+                if self.heads[endpoint] != head:
+                    self.heads[endpoint] = head
+                    self.cond.notify_all()
+        with self.cond:
+            self.update_lagging()
+
+    def run(self):
+        while True:
+            self.poll()
+            time.sleep(self.interval)
+
+    def start(self):
+        threading.Thread(target=self.run, name="replica-heads", daemon=True).start()
+
+readReplicas = ReadReplicas(readEndpoints, int(os.getenv("HEAD_POLL_INTERVAL_MS", 500)) / 1000, float(os.getenv("REPLICA_MAX_LAG_SECONDS", 10)), libTracker)
+if len(readEndpoints) > 1:
+    headTracker.follow = readReplicas.freshest
+
+class UpstreamPool:
+    """Endpoints dedicated to heavy calls, with at most limit calls in flight across them.
+
+    Calls over the limit wait for a slot, no longer than the client deadline or
+    queue_timeout, so a burst of traces queues here instead of tying up the
+    evm-rpc workers that serve the read replicas.
+    """
+
+    def __init__(self, name, endpoints, limit, queue_timeout):
+        self.name = name
+        self.endpoints = endpoints
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(limit)
+        self.lock = threading.Lock()
+        self.next = 0
+
+    def post(self, req, trace):
+        start = time.perf_counter()
+        remaining = trace.remaining()
+        timeout = self.queue_timeout if remaining is None else min(self.queue_timeout, remaining)
+        if not self.slots.acquire(timeout=max(timeout, 0)):
+            if remaining is not None and trace.remaining() <= 0:
+                raise DeadlineExceeded()
+            return jsonrpc_error(req, -32005, "upstream pool %s busy" % self.name)
+        trace.add("queue", time.perf_counter() - start)
+        try:
+            with self.lock:
+                endpoint = self.endpoints[self.next % len(self.endpoints)]
+                self.next += 1
+            return post_upstream(endpoint, req, trace)
+        finally:
+            self.slots.release()
+
+def build_upstream_pools():
+    # UPSTREAM_POOLS="trace=http://host1:8881|http://host2:8881", POOL_CONCURRENCY="trace=4"
+    limits = parse_method_table(os.getenv("POOL_CONCURRENCY", ""), int)
+    queueTimeout = int(os.getenv("POOL_QUEUE_TIMEOUT_MS", 5000)) / 1000
+    pools = {}
+    for name, endpoints in parse_method_table(os.getenv("UPSTREAM_POOLS", ""), str).items():
+        endpoints = [e.strip() for e in endpoints.split("|") if e.strip()]
+        if endpoints:
+            pools[name] = UpstreamPool(name, endpoints, limits.get(name, 8), queueTimeout)
+    return pools
+
+upstreamPools = build_upstream_pools()
+# read methods served by a pool instead of the read replicas, routes to pools that are not configured are ignored
+poolRoutes = {method: name for method, name in parse_method_table(os.getenv("POOL_ROUTES", "debug_*=trace,trace_*=trace"), str).items() if name in upstreamPools}
+
+class RecentTransactions:
+    """Hashes of transactions sent through this proxy in the last window seconds."""
+
+    def __init__(self, window, max_entries=100000):
+        self.window = window
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.sent = OrderedDict()
+
+    def add(self, tx_hash):
+        now = time.monotonic()
+        with self.lock:
+            self.sent[tx_hash.lower()] = now
+            self.sent.move_to_end(tx_hash.lower())
+            while self.sent and (len(self.sent) > self.max_entries or next(iter(self.sent.values())) < now - self.window):
+                self.sent.popitem(last=False)
+
+    def __contains__(self, tx_hash):
+        with self.lock:
+            sent = self.sent.get(tx_hash.lower())
+        return sent is not None and sent >= time.monotonic() - self.window
+
+recentTxs = RecentTransactions(float(os.getenv("READ_YOUR_WRITES_WINDOW", 120)))
+# how long a receipt lookup of a fresh transaction may wait for a replica to reach the next block
+receiptHoldSeconds = int(os.getenv("READ_YOUR_WRITES_HOLD_MS", 1500)) / 1000
+
+def get_recent_receipt(req, trace):
+    """eth_getTransactionReceipt for a transaction sent through this proxy.
+
+    Asks the replica with the highest head, and if it has no receipt yet, waits
+    briefly for any replica to produce a newer block and asks again. Only the
+    first such wait of a request holds, so a batch of fresh receipts waits for
+    one new block at most rather than one per element.
+    """
+    endpoint, head = readReplicas.highest()
+    resp = post_upstream(endpoint, req, trace)
+    if type(resp) != dict or resp.get("result") is not None or head is None or trace.receipt_held:
+        return resp
+    trace.receipt_held = True
+    hold = receiptHoldSeconds
+    remaining = trace.remaining()
+    if remaining is not None:
+        hold = min(hold, remaining)
+    start = time.perf_counter()
+    newer = readReplicas.wait_for_head_above(head, hold)
+    trace.add("upstream-wait", time.perf_counter() - start)
+    if newer is None or newer <= head:
+        return resp
+    endpoint, head = readReplicas.highest()
+    return post_upstream(endpoint, req, trace)
+
+class ReceiptWaiter:
+    """Serves proxy_waitForTransactionReceipt, a long-poll alternative to polling eth_getTransactionReceipt.
+
+    Waiting requests are parked per transaction hash. On every new head one
+    upstream batch asks for the receipts of all parked hashes and wakes the
+    requests whose transaction got mined. Each parked request holds a server
+    thread, so at most max_waiters are parked at a time and requests over
+    that are turned away.
+    """
+
+    def __init__(self, max_wait, max_waiters):
+        self.max_wait = max_wait
+        self.max_waiters = max_waiters
+        self.lock = threading.Lock()
+        self.waiting = {}
+        self.parked = 0
+        self.heads = queue.Queue()
+
+    def on_new_head(self, block, previous, forked):
+        self.heads.put(block["number"])
+
+    def check(self):
+        with self.lock:
+            hashes = list(self.waiting)
+        if not hashes:
+            return
+        calls = [{"jsonrpc": "2.0", "id": i, "method": "eth_getTransactionReceipt", "params": [h]} for i, h in enumerate(hashes)]
+        results = post_upstream(readReplicas.highest()[0], calls)
+        if type(results) != list:
+            raise ValueError("invalid response to receipt batch")
+        with self.lock:
+            for r in results:
+                if type(r.get("id")) != int or not 0 <= r["id"] < len(hashes) or r.get("result") is None:
+                    continue
+                entry = self.waiting.pop(hashes[r["id"]], None)
+                if entry is not None:
+                    entry["receipt"] = r["result"]
+                    entry["event"].set()
+
+    def run(self):
+        while True:
+            self.heads.get()
+            while not self.heads.empty():
+                self.heads.get()
+            try:
+                self.check()
+            except Exception as e:
+                proxyLog.warning("receipt check failed: %s", e)
+
+    def start(self):
+        threading.Thread(target=self.run, name="receipt-waiter", daemon=True).start()
+
+    def wait(self, req, trace):
+        params = req.get("params")
+        if type(params) != list or not params or type(params[0]) != str:
+            return jsonrpc_error(req, -32602, "invalid params")
+        timeout = self.max_wait
+        if len(params) > 1 and type(params[1]) in (int, float):
+            timeout = min(timeout, params[1] / 1000)
+        remaining = trace.remaining()
+        if remaining is not None:
+            timeout = min(timeout, remaining)
+        tx_hash = params[0].lower()
+        # park first so a block produced during the check below is not missed
+        with self.lock:
+            if self.parked >= self.max_waiters:
+                return jsonrpc_error(req, -32005, "too many waiting requests")
+            self.parked += 1
+            entry = self.waiting.setdefault(tx_hash, {"event": threading.Event(), "receipt": None, "waiters": 0})
+            entry["waiters"] += 1
+        try:
+            resp = post_upstream(readReplicas.highest()[0], {"jsonrpc": "2.0", "id": req.get("id"), "method": "eth_getTransactionReceipt", "params": [tx_hash]}, trace)
+            if type(resp) != dict or resp.get("result") is not None:
+                return resp
+            start = time.perf_counter()
+            entry["event"].wait(timeout)
+            trace.add("upstream-wait", time.perf_counter() - start)
+            return {"jsonrpc": "2.0", "id": req.get("id"), "result": entry["receipt"]}
+        finally:
+            with self.lock:
+                self.parked -= 1
+                entry["waiters"] -= 1
+                if entry["waiters"] == 0 and self.waiting.get(tx_hash) is entry:
+                    del self.waiting[tx_hash]
+
+receiptWaiter = None
+if os.getenv("RECEIPT_WAIT", "0") == "1":
+    receiptWaiter = ReceiptWaiter(int(os.getenv("RECEIPT_WAIT_MAX_MS", 30000)) / 1000, int(os.getenv("RECEIPT_WAIT_MAX_WAITERS", 256)))
+    headTracker.add_listener(receiptWaiter.on_new_head)
+
+def null_cache_key(req):
+    # receipts of unmined transactions and blocks past the head come back null until the next block
+    params = req.get("params")
+    if type(params) != list or not params or type(params[0]) != str:
+        return None
+    if req["method"] == "eth_getTransactionReceipt" and len(params) == 1:
+        return "eth_getTransactionReceipt" + params[0].lower()
+    if req["method"] == "eth_getBlockByNumber" and len(params) == 2:
+        tag = block_number_param(params[0])
+        return None if tag is None else "eth_getBlockByNumber%s,%s" % (tag, bool(params[1]))
+    return None
+
+class NullCache:
+    """Remembers null answers for less than one EVM block; emptied whenever the head moves."""
+
+    def __init__(self, ttl, max_entries=100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def hit(self, key):
+        with self.lock:
+            expires = self.entries.get(key)
+        return expires is not None and expires > time.monotonic()
+
+    def add(self, key):
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                self.entries.clear()
+            self.entries[key] = time.monotonic() + self.ttl
+
+    def on_new_head(self, block, previous, forked):
+        with self.lock:
+            self.entries.clear()
+
+# EVM blocks are one second apart, see timestamp_to_evm_block_num in eos-evm-ws-proxy
+nullCacheTtl = int(os.getenv("NULL_CACHE_TTL_MS", 500)) / 1000
+nullCache = NullCache(nullCacheTtl) if nullCacheTtl > 0 else None
+if nullCache is not None:
+    headTracker.add_listener(nullCache.on_new_head)
+
+class ShadowMirror:
+    """Mirrors a sample of replica reads to a candidate evm-rpc and compares its answers with the primary's.
+
+    Sampled calls are queued after the primary answered and sent by a worker
+    thread; when the queue is full the sample is dropped, so the primary
+    response never waits. Every interval seconds a summary of the latency
+    delta (shadow minus primary) and the mismatch count is logged. Mismatches
+    are logged and, with mismatch_path set, appended to that JSONL file with
+    both answers. Unpinned calls can differ just because a head moved.
+    """
+
+    def __init__(self, endpoint, percent, max_queue, interval, mismatch_path):
+        self.endpoint = endpoint
+        self.percent = percent
+        self.interval = interval
+        self.queue = queue.Queue(max_queue)
+        self.mismatch_file = open(mismatch_path, "a", buffering=1) if mismatch_path else None
+        self.reset()
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.deltas = []
+        self.mismatches = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def offer(self, req, resp, seconds, pinned):
+        if random.random() * 100 >= self.percent:
+            return
+        try:
+            self.queue.put_nowait((req, resp, seconds, pinned))
+        except queue.Full:
+            self.dropped += 1
+
+    @staticmethod
+    def same(primary, shadow):
+        if type(primary) != dict or type(shadow) != dict:
+            return primary == shadow
+        if "error" in primary or "error" in shadow:
+            return (primary.get("error") or {}).get("code") == (shadow.get("error") or {}).get("code")
+        return primary.get("result") == shadow.get("result")
+
+    def compare(self, req, primary, seconds, pinned):
+        start = time.perf_counter()
+        try:
+            shadow = post_upstream(self.endpoint, req)
+        except (requests.RequestException, ValueError) as e:
+            proxyLog.debug("shadow call %s failed: %s", req["method"], e)
+            self.errors += 1
+            return
+        self.deltas.append(time.perf_counter() - start - seconds)
+        if self.same(primary, shadow):
+            return
+        self.mismatches += 1
+        proxyLog.warning("shadow mismatch method=%s pinned=%s params=%s", req["method"], pinned, json.dumps(req.get("params"))[:200])
+        if self.mismatch_file is not None:
+            self.mismatch_file.write(json.dumps({"ts": time.time(), "method": req["method"], "params": req.get("params"),
+                "pinned": pinned, "primary": primary, "shadow": shadow}) + "\n")
+
+    def report(self):
+        if not (self.deltas or self.errors or self.dropped):
+            self.reset()
+            return
+        deltas = sorted(self.deltas)
+        def ms(p):
+            return deltas[min(len(deltas) - 1, int(len(deltas) * p / 100))] * 1000 if deltas else 0.0
+        proxyLog.info("shadow %s: compared=%d mismatches=%d errors=%d dropped=%d delta_ms p50=%.3f p90=%.3f p99=%.3f",
+            self.endpoint, len(deltas), self.mismatches, self.errors, self.dropped, ms(50), ms(90), ms(99))
+        self.reset()
+
+    def run(self):
+        while True:
+            try:
+                self.compare(*self.queue.get(timeout=self.interval))
+            except queue.Empty:
+                pass
+            if time.monotonic() - self.started >= self.interval:
+                self.report()
+
+    def start(self):
+        threading.Thread(target=self.run, name="shadow-mirror", daemon=True).start()
+
+# candidate evm-rpc that SHADOW_SAMPLE_PERCENT percent of replica reads are mirrored to
+shadowEndpoint = os.getenv("SHADOW_RPC_ENDPOINT")
+shadowMirror = ShadowMirror(shadowEndpoint, float(os.getenv("SHADOW_SAMPLE_PERCENT", 1)), int(os.getenv("SHADOW_QUEUE_SIZE", 1000)),
+    int(os.getenv("SHADOW_REPORT_INTERVAL", 60)), os.getenv("SHADOW_MISMATCH_FILE")) if shadowEndpoint else None
+
+def read_local(req, head, trace):
+    """Answers a read from the caches, the block index or the recent-transaction path.
+
+    Returns (response, None), or (None, plan) when the call has to go upstream;
+    the upstream response then goes through read_store with that plan.
+    """
+    key, number = cache_key(req)
+    if responseCache is None or (head is not None and number is not None and number > head):
+        key = None
+    if key is not None:
+        hit = responseCache.get(key)
+        if hit is not ResponseCache.MISS:
+            encoded, trace.etag = hit
+            return envelope(req.get("id"), encoded), None
+    if blockIndex is not None:
+        result = blockIndex.answer(req)
+        if result is not BlockIndex.MISS:
+            return {"jsonrpc": "2.0", "id": req.get("id"), "result": result}, None
+    params = req.get("params")
+    if req["method"] == "eth_getTransactionReceipt" and type(params) == list and params and type(params[0]) == str and params[0] in recentTxs:
+        return get_recent_receipt(req, trace), None
+    null_key = null_cache_key(req) if nullCache is not None else None
+    if null_key is not None and nullCache.hit(null_key):
+        return {"jsonrpc": "2.0", "id": req.get("id"), "result": None}, None
+    return None, (key, number, null_key)
+
+def read_store(req, head, resp, plan, trace=None):
+    key, number, null_key = plan
+    if type(resp) != dict or "result" not in resp:
+        return resp
+    if resp["result"] is None:
+        if null_key is not None:
+            nullCache.add(null_key)
+    # evm-rpc may not have indexed the logs of the head block yet, leave those to the prefetcher
+    elif key is not None and (req["method"] != "eth_getLogs" or head is None or number < head):
+        if req["method"] == "eth_getBlockByNumber" and req["params"][1]:
+            blockIndex.add(resp["result"])
+        encoded, etag = responseCache.put(key, resp["result"], number)
+        if trace is not None:
+            trace.etag = etag
+        return envelope(req.get("id"), encoded)
+    return resp
+
+def replica_block(plan):
+    # block a replica needs to have for the call, None when it is latest-sensitive or pinned to a hash
+    key, number, null_key = plan
+    return number
+
+def forward_read(req, head, trace):
+    resp, plan = read_local(req, head, trace)
+    if plan is None:
+        return resp
+    pool = lookup_method(poolRoutes, req["method"])
+    if pool is not None:
+        resp = upstreamPools[pool].post(req, trace)
+    else:
+        start = time.perf_counter()
+        resp = post_upstream(readReplicas.pick(replica_block(plan)), req, trace)
+        if shadowMirror is not None:
+            shadowMirror.offer(req, resp, time.perf_counter() - start, replica_block(plan) is not None)
+    return read_store(req, head, resp, plan, trace)
+
+class PendingRead:
+    """A batch element on its way to a read replica as part of a sub-batch."""
+
+    def __init__(self, req, plan):
+        self.req = req
+        self.plan = plan
+        self.future = None
+        self.position = None
+        self.last = False
+
+    def result(self):
+        return self.future.result()[self.position]
+
+class SubBatcher:
+    """Sends the replica-bound elements of large client batches as concurrent upstream sub-batches.
+
+    evm-rpc pays a fixed cost per HTTP call plus a cost per element, and one huge
+    batch holds a single worker for its whole length. Observed sub-batch
+    latencies are fitted to overhead + per_element * size by exponentially
+    weighted least squares, and sub-batches are sized to take about target
+    seconds each, within [min_size, max_size].
+    """
+
+    def __init__(self, target, min_size, max_size, workers, decay=0.95):
+        self.target = target
+        self.min_size = min_size
+        self.max_size = max_size
+        self.decay = decay
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sub-batch")
+        self.lock = threading.Lock()
+        # weight, sum of sizes, sum of latencies, sum of squared sizes, sum of size * latency
+        self.stats = (0.0, 0.0, 0.0, 0.0, 0.0)
+
+    def observe(self, size, seconds):
+        with self.lock:
+            w, sx, sy, sxx, sxy = (v * self.decay for v in self.stats)
+            self.stats = (w + 1, sx + size, sy + seconds, sxx + size * size, sxy + size * seconds)
+
+    def size(self):
+        with self.lock:
+            w, sx, sy, sxx, sxy = self.stats
+        if w < 1:
+            return min(max(50, self.min_size), self.max_size)
+        spread = w * sxx - sx * sx
+        if w >= 2 and spread > 1e-9 * w * sxx:
+            per_element = (w * sxy - sx * sy) / spread
+            overhead = max((sy - per_element * sx) / w, 0.0)
+        else:
+            # all sizes alike so far, charge everything to the elements
+            per_element, overhead = sy / sx, 0.0
+        if per_element <= 0:
+            return self.max_size
+        return int(max(self.min_size, min(self.max_size, (self.target - overhead) / per_element)))
+
+    def submit(self, chunk, head, trace):
+        future = self.executor.submit(self.run, chunk, head, trace)
+        for position, p in enumerate(chunk):
+            p.future, p.position = future, position
+        chunk[-1].last = True
+
+    def run(self, chunk, head, trace):
+        # positions stand in for the client's ids, which need not be unique
+        body = [dict(p.req, id=position) for position, p in enumerate(chunk)]
+        blocks = [replica_block(p.plan) for p in chunk if replica_block(p.plan) is not None]
+        endpoint = readReplicas.pick(max(blocks) if blocks else None)
+        start = time.perf_counter()
+        resp = post_upstream(endpoint, body, trace)
+        by_position = {}
+        if type(resp) == list:
+            self.observe(len(body), time.perf_counter() - start)
+            for r in resp:
+                if type(r) == dict and type(r.get("id")) == int and 0 <= r["id"] < len(chunk):
+                    by_position[r["id"]] = r
+        results = []
+        for position, p in enumerate(chunk):
+            r = by_position.get(position)
+            if r is None:
+                # a batch-level error applies to every element
+                r = resp if type(resp) == dict and "error" in resp else jsonrpc_error(p.req, -32603, "no response from upstream")
+            results.append(read_store(p.req, head, dict(r, id=p.req.get("id")), p.plan))
+        return results
+
+class BatchWindow:
+    """Forwards the elements of one client batch ahead of serialization, in order, within a bounded window.
+
+    Reads bound for a replica are collected into sub-batches that start at
+    min_size elements and double up to SubBatcher.size(). At most window
+    sub-batches, and window * max_size elements, are forwarded and not yet
+    taken, which bounds the memory a huge batch holds. Elements are only
+    forwarded ahead while their expected encoded size, averaged over the
+    elements taken so far, fits in the budget left under the byte cap, so
+    little goes upstream past the cap.
+    """
+
+    def __init__(self, reqs, forward, batcher, window, head, trace):
+        self.reqs = reqs
+        self.forward = forward
+        self.batcher = batcher
+        self.window = window
+        self.head = head
+        self.trace = trace
+        self.next = 0
+        self.ahead = deque()
+        self.chunk = []
+        self.chunk_size = batcher.min_size
+        self.inflight = 0
+        self.taken = 0
+        self.taken_bytes = 0
+
+    def defer(self, p):
+        self.chunk.append(p)
+        return p
+
+    def submit(self):
+        if self.chunk:
+            self.batcher.submit(self.chunk, self.head, self.trace)
+            self.inflight += 1
+            self.chunk = []
+            self.chunk_size = min(self.chunk_size * 2, max(self.batcher.size(), self.batcher.min_size))
+
+    def fits(self, budget):
+        if self.taken == 0:
+            return len(self.ahead) < self.batcher.min_size
+        return (len(self.ahead) + 1) * self.taken_bytes / self.taken <= budget
+
+    def take(self, budget):
+        """Next response in order; budget is the number of bytes left under the cap."""
+        while self.next < len(self.reqs) and (not self.ahead or (self.inflight < self.window and
+                len(self.ahead) < self.window * self.batcher.max_size and self.fits(budget))):
+            self.ahead.append(self.forward(self.reqs[self.next], self.defer))
+            self.next += 1
+            if len(self.chunk) >= self.chunk_size:
+                self.submit()
+        resp = self.ahead.popleft()
+        if type(resp) == PendingRead:
+            if resp.future is None:
+                self.submit()
+            if resp.last:
+                self.inflight -= 1
+        return resp
+
+    def taken_size(self, size):
+        self.taken += 1
+        self.taken_bytes += size
+
+# client batches with at least this many elements send their replica-bound reads as sub-batches, 0 disables
+subBatchThreshold = int(os.getenv("SUB_BATCH_THRESHOLD", 8))
+subBatcher = SubBatcher(int(os.getenv("SUB_BATCH_TARGET_MS", 250)) / 1000, int(os.getenv("SUB_BATCH_MIN", 4)),
+    int(os.getenv("SUB_BATCH_MAX", 500)), int(os.getenv("SUB_BATCH_WORKERS", 16))) if subBatchThreshold > 0 else None
+# sub-batches of one client batch in flight at a time
+subBatchWindow = int(os.getenv("SUB_BATCH_WINDOW", 4))
+
+etagsEnabled = os.getenv("ETAGS", "1") == "1"
+# methods named in a request's debug log line, the rest of a batch is only counted
+logMethods = int(os.getenv("LOG_MAX_METHODS", 10))
+
+def tag_response(resp, etag=None):
+    """Returns (response, ETag) for a single read response.
+
+    The tag is a hash of the encoded result only, so polls with different ids
+    still match. etag is the tag the response cache keeps for the result of
+    an envelope() response, which then is not hashed again. Dict responses
+    come back as envelope() bytes so the result is encoded once. Errors get
+    no tag.
+    """
+    if type(resp) == bytes and etag is not None:
+        return resp, etag
+    if type(resp) == bytes:
+        # envelope() output: the id is JSON-encoded, so its strings cannot contain an unescaped ',"result":'
+        result = resp[resp.index(b',"result":') + len(b',"result":'):-1]
+    elif type(resp) == dict and "result" in resp and "error" not in resp:
+        result = encode_result(resp["result"])
+        resp = envelope(resp.get("id"), result)
+    else:
+        return resp, None
+    return resp, result_etag(result)
+
+def etag_matches(header, etag):
+    if not header:
+        return False
+    tags = [t.strip() for t in header.split(",")]
+    # weak comparison, as If-None-Match calls for
+    return "*" in tags or etag in tags or etag[2:] in tags
 
 @app.route("/", methods=["POST"])
 def default():
-    def forward_request(req):
-        if type(req) == dict and ("method" in req) and (req["method"] in writemethods):
-            #print("send req to miner:" + str(req))
-            resp = requests.post(writeEndpoint, json.dumps(req), headers={"Accept":"application/json","Content-Type":"application/json"}).json()
-            #print("got resp from miner:" + str(resp))
-            return resp
+    def forward_request(req, batch, defer=None):
+        remaining = g.trace.remaining()
+        if remaining is not None and remaining <= 0:
+            # the client can no longer use the answer, don't spend upstream capacity on it
+            raise DeadlineExceeded()
+        if type(req) != dict or type(req.get("method")) != str:
+            return jsonrpc_error(req, -32600, "invalid request")
+        if req.get("jsonrpc") != "2.0":
+            return jsonrpc_error(req, -32600, "jsonrpc version not supported")
+        if req["method"] == "proxy_waitForTransactionReceipt" and receiptWaiter is not None:
+            if batch:
+                return jsonrpc_error(req, -32600, "proxy_waitForTransactionReceipt is not allowed in a batch")
+            return receiptWaiter.wait(req, g.trace)
+        route = route_of(req["method"])
+        if route is None:
+            return jsonrpc_error(req, -32601, "method not allowed: " + req["method"])
+        if batch and route == "write" and req["method"] != "eth_gasPrice":
+            return jsonrpc_error(req, -32600, "batch write calls not allowed")
+        if pinBlockTags:
+            req = pin_block_tag(req, g.head, g.lib)
+        if req["method"] == "eth_gasPrice" and gasPriceCache is not None:
+            return gasPriceCache.get(req, g.trace)
+        if route == "read":
+            if defer is not None and lookup_method(poolRoutes, req["method"]) is None:
+                resp, plan = read_local(req, g.head, g.trace)
+                return resp if plan is None else defer(PendingRead(req, plan))
+            return forward_read(req, g.head, g.trace)
+        resp = post_upstream(routeEndpoints[route], req, g.trace)
+        if req["method"] == "eth_sendRawTransaction" and type(resp) == dict and type(resp.get("result")) == str:
+            recentTxs.add(resp["result"])
+        return resp
+
+    def guarded(req, call):
+        try:
+            return call()
+        except DeadlineExceeded:
+            return jsonrpc_error(req, -32000, "request deadline exceeded")
+        except requests.Timeout:
+            return jsonrpc_error(req, -32603, "upstream timed out")
+        except requests.RequestException as e:
+            proxyLog.warning("request_id=%s upstream failed: %s", g.trace.request_id, e)
+            return jsonrpc_error(req, -32603, "upstream unavailable")
+
+    def timed_forward(req, batch, defer=None):
+        start = time.perf_counter()
+        resp = guarded(req, lambda: forward_request(req, batch, defer))
+        g.trace.add_element(req.get("method") if type(req) == dict else None, time.perf_counter() - start)
+        return resp
+
+
+    def serialize_batch(reqs):
+        # each element is encoded and handed out as soon as it and all earlier ones are done;
+        # once the byte cap is hit the remaining elements are answered with an error, unforwarded unless
+        # a sub-batch window already sent them
+        window = None
+        if subBatcher is not None and len(reqs) >= subBatchThreshold:
+            window = BatchWindow(reqs, lambda r, defer: timed_forward(r, True, defer), subBatcher, subBatchWindow, g.head, g.trace)
+        size = len(b"[]")
+        for i, r in enumerate(reqs):
+            if size <= maxBatchResponseBytes:
+                resp = timed_forward(r, True) if window is None else window.take(maxBatchResponseBytes - size)
+                if type(resp) == PendingRead:
+                    start = time.perf_counter()
+                    resp = guarded(r, resp.result)
+                    method, seconds = g.trace.elements[i]
+                    g.trace.elements[i] = (method, seconds + time.perf_counter() - start)
+            else:
+                resp = jsonrpc_error(r, -32000, "batch response size limit exceeded")
+                if window is None or i >= window.next:
+                    g.trace.add_element(r.get("method") if type(r) == dict else None, 0.0)
+            start = time.perf_counter()
+            # cache hits come back already encoded
+            chunk = resp if type(resp) == bytes else json.dumps(resp, separators=(",", ":")).encode()
+            if size + len(chunk) + 1 > maxBatchResponseBytes:
+                chunk = json.dumps(jsonrpc_error(r, -32000, "batch response size limit exceeded"), separators=(",", ":")).encode()
+                size = maxBatchResponseBytes + 1
+            else:
+                size += len(chunk) + 1
+            g.trace.sizes.append(len(chunk))
+            if window is not None:
+                window.taken_size(len(chunk))
+            g.trace.add("serialize", time.perf_counter() - start)
+            yield (b"[" if i == 0 else b",") + chunk
+        yield b"]" if reqs else b"[]"
+
+    def finish(batch, request_data):
+        if recorder is not None:
+            recorder.record(g.trace, request.remote_addr, batch, request_data if batch else [request_data])
+        if slowLog is not None:
+            slowLog.check(g.trace, batch, request_data if batch else [request_data], g.head)
+        # like werkzeug's access log, quiet by default; large batches only show their first methods
+        if proxyLog.isEnabledFor(logging.DEBUG):
+            methods = [short_str(e[0], 64) for e in g.trace.elements[:logMethods]]
+            more = len(g.trace.elements) - len(methods)
+            proxyLog.debug("request_id=%s elements=%d methods=%s%s total=%.3fms", g.trace.request_id, len(g.trace.elements),
+                ",".join(str(m) for m in methods), ",+%d more" % more if more else "", g.trace.total() * 1000)
+
+    def stream_batch(request_data):
+        try:
+            yield from serialize_batch(request_data)
+        finally:
+            finish(True, request_data)
+
+    g.trace = RequestTrace(request.headers.get("X-Request-Id") or uuid.uuid4().hex)
+    queued = queue_time()
+    g.trace.add("queue", queued)
+    try:
+        budget = float(request.headers[deadlineHeader])
+        # nan, inf and overflowing values parse too but make no deadline
+        if not math.isfinite(budget) or budget <= 0:
+            raise ValueError(budget)
+        g.trace.set_budget(budget / 1000 - queued)
+    except (KeyError, ValueError):
+        pass
+    # one head for the whole request so every element of a batch sees the same snapshot
+    g.head = headTracker.number()
+    g.lib = libTracker.lib
+
+    start = time.perf_counter()
+    try:
+        request_data = read_json_body()
+    except RequestRejected as e:
+        proxyLog.warning("request_id=%s rejected: %s", g.trace.request_id, e)
+        response = jsonify(jsonrpc_error(None, e.code, str(e)))
+        response.status_code = e.status
+        response.headers["X-Request-Id"] = g.trace.request_id
+        return response
+    g.trace.add("parse", time.perf_counter() - start)
+
+    batch = type(request_data) == list
+    if batch and len(request_data) >= streamBatchThreshold:
+        # Server-Timing can only carry what is known before the first byte goes out
+        return Response(stream_with_context(stream_batch(request_data)), mimetype="application/json",
+            headers={"X-Request-Id": g.trace.request_id, "Server-Timing": g.trace.server_timing(False)})
+
+    if not batch:
+        res = timed_forward(request_data, False)
+        start = time.perf_counter()
+        etag = None
+        if etagsEnabled and type(request_data) == dict and type(request_data.get("method")) == str and route_of(request_data["method"]) == "read":
+            res, etag = tag_response(res, g.trace.etag)
+        if etag is not None and etag_matches(request.headers.get("If-None-Match"), etag):
+            response = Response(status=304)
+            g.trace.sizes.append(0)
         else:
-            #print("send req to evm-rpc:" + str(req))
-            resp = requests.post(readEndpoint, json.dumps(req), headers={"Accept":"application/json","Content-Type":"application/json"}).json()
-            #print("got from evm-rpc:" + str(resp))
-            return resp
+            response = Response(res, mimetype="application/json") if type(res) == bytes else jsonify(res)
+            g.trace.sizes.append(response.content_length)
+        if etag is not None:
+            response.headers["ETag"] = etag
+        g.trace.add("serialize", time.perf_counter() - start)
+    else:
+        response = Response(b"".join(serialize_batch(request_data)), mimetype="application/json")
+
+    finish(batch, request_data)
+    response.headers["X-Request-Id"] = g.trace.request_id
+    response.headers["Server-Timing"] = g.trace.server_timing(batch)
+    return response
+
+class SamplingProfiler:
+    """Samples the Python stacks of all threads at a fixed rate for a while.
+
+    Stacks are counted in the collapsed format flamegraph.pl and speedscope
+    read, rooted at the thread name. Garbage collector pauses are timed through
+    gc.callbacks for the same window, and with allocations set tracemalloc
+    reports the lines that allocated the most while sampling.
+    """
+
+    def __init__(self, hz):
+        self.interval = 1.0 / hz
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def frame_name(code):
+        return "%s (%s:%d)" % (getattr(code, "co_qualname", code.co_name), os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def profile(self, seconds, allocations):
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            return self.sample(seconds, allocations)
+        finally:
+            self.lock.release()
 
-    request_data = request.get_json()
-    if type(request_data) == dict:
-        return jsonify(forward_request(request_data))
+    def sample(self, seconds, allocations):
+        stacks = {}
+        pauses = {0: [], 1: [], 2: []}
+        gc_started = {}
+        def on_gc(phase, info):
+            if phase == "start":
+                gc_started["at"] = time.perf_counter()
+            elif "at" in gc_started:
+                pauses[info["generation"]].append(time.perf_counter() - gc_started.pop("at"))
+        tracing = allocations and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        before = tracemalloc.take_snapshot() if allocations else None
+        gc.callbacks.append(on_gc)
+        me = threading.get_ident()
+        samples = 0
+        deadline = time.perf_counter() + seconds
+        try:
+            while time.perf_counter() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self.frame_name(frame.f_code))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    key = ";".join(reversed(stack))
+                    stacks[key] = stacks.get(key, 0) + 1
+                samples += 1
+                time.sleep(self.interval)
+        finally:
+            gc.callbacks.remove(on_gc)
+        result = {"seconds": seconds, "samples": samples,
+            "collapsed": "".join("%s %d\n" % item for item in sorted(stacks.items())),
+            "gc": {"gen%d" % gen: {"collections": len(p), "pause_ms_total": sum(p) * 1000, "pause_ms_max": max(p, default=0.0) * 1000}
+                for gen, p in pauses.items()}}
+        result["gc"]["objects"] = len(gc.get_objects())
+        if allocations:
+            after = tracemalloc.take_snapshot()
+            if tracing:
+                tracemalloc.stop()
+            # leave out what the sampling loop itself allocated
+            code = self.sample.__code__
+            own = [tracemalloc.Filter(False, code.co_filename, lineno) for lineno in {l for _, _, l in code.co_lines() if l}]
+            result["allocations"] = [{"line": str(stat.traceback[0]), "size_diff": stat.size_diff, "count_diff": stat.count_diff}
+                for stat in after.filter_traces(own).compare_to(before.filter_traces(own), "lineno")[:25]]
+        return result
 
-    res = []
-    for r in request_data:
-        res.append(forward_request(r))
+# /debug/profile is only served with a token set, clients pass it as "Authorization: Bearer <token>"
+profileToken = os.getenv("PROFILE_TOKEN")
+profiler = SamplingProfiler(int(os.getenv("PROFILE_SAMPLE_HZ", 100)))
+maxProfileSeconds = int(os.getenv("MAX_PROFILE_SECONDS", 60))
 
-    return jsonify(res)
+@app.route("/debug/profile", methods=["GET"])
+def debug_profile():
+    if not profileToken:
+        return Response(status=404)
+    if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), ("Bearer " + profileToken).encode()):
+        return Response(status=401)
+    try:
+        seconds = float(request.args.get("seconds", 10))
+    except ValueError:
+        return Response("seconds must be a number\n", status=400, mimetype="text/plain")
+    seconds = min(max(seconds, 0.0), maxProfileSeconds)
+    result = profiler.profile(seconds, request.args.get("allocations") == "1")
+    if result is None:
+        return Response("a profile is already running\n", status=409, mimetype="text/plain")
+    if request.args.get("format") == "collapsed":
+        return Response(result["collapsed"], mimetype="text/plain")
+    return jsonify(result)
 
-app.run(host='0.0.0.0', port=flaskListenPort)
+if __name__ == "__main__":
+    if responseCache is not None and responseCache.disk is not None:
+        responseCache.disk.start()
+    if prefetcher is not None:
+        prefetcher.start()
+    if receiptWaiter is not None:
+        receiptWaiter.start()
+    libTracker.start()
+    headTracker.start()
+    readReplicas.start()
+    if shadowMirror is not None:
+        shadowMirror.start()
+    if flaskListenSocket:
+        app.run(host="unix://" + flaskListenSocket)
+    else:
+        app.run(host='0.0.0.0', port=flaskListenPort)
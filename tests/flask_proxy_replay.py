@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Replays a JSON-RPC capture written by flask_proxy.py (CAPTURE_FILE) against an endpoint.
+#
+#   flask_proxy_replay.py CAPTURE_FILE [--endpoint URL] [--speed N] [--connections N]
+#
+# --speed 1 keeps the original inter-arrival times, --speed 10 plays ten times
+# faster and --speed 0 sends as fast as the connections allow. Elements captured
+# as one batch are sent as one batch again. Latency is measured from the time a
+# call was due to be sent (or was queued, at --speed 0), so time spent waiting
+# for a free connection counts and overload shows up in the percentiles.
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+parser = argparse.ArgumentParser(description="replay a flask_proxy JSON-RPC capture")
+parser.add_argument("capture", help="JSONL file written by flask_proxy.py with CAPTURE_FILE set")
+parser.add_argument("--endpoint", default="http://127.0.0.1:5000", help="JSON-RPC endpoint to replay against")
+parser.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier, 0 for max speed")
+parser.add_argument("--connections", type=int, default=8, help="number of concurrent connections")
+args = parser.parse_args()
+
+def load_calls(path):
+    calls = []
+    batches = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            rec = json.loads(line)
+            req = {"jsonrpc": "2.0", "id": len(calls), "method": rec["method"]}
+            if rec.get("params") is not None:
+                req["params"] = rec["params"]
+            # request_id comes from the client and may repeat, seq and ts tell its requests apart
+            batch = (rec["request_id"], rec["ts"], rec.get("seq"))
+            if rec.get("batch_index") is None:
+                calls.append((rec["ts"], req))
+            elif batch in batches:
+                batches[batch][1].append(req)
+            else:
+                batches[batch] = (rec["ts"], [req])
+                calls.append(batches[batch])
+    calls.sort(key=lambda c: c[0])
+    return calls
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+calls = load_calls(args.capture)
+print("replaying {} calls from {} against {} (speed={}, connections={})".format(len(calls), args.capture, args.endpoint, args.speed or "max", args.connections))
+
+local = threading.local()
+lock = threading.Lock()
+latencies = []
+errors = [0]
+
+def send(req, scheduled):
+    if not hasattr(local, "session"):
+        local.session = requests.Session()
+    try:
+        resp = local.session.post(args.endpoint, json.dumps(req), headers={"Accept":"application/json","Content-Type":"application/json"})
+        ok = resp.status_code == 200
+    except requests.RequestException:
+        ok = False
+    elapsed = time.perf_counter() - scheduled
+    with lock:
+        latencies.append(elapsed)
+        if not ok:
+            errors[0] += 1
+
+started = time.perf_counter()
+with ThreadPoolExecutor(max_workers=args.connections) as pool:
+    first_ts = calls[0][0] if calls else 0
+    for ts, req in calls:
+        if args.speed > 0:
+            scheduled = started + (ts - first_ts) / args.speed
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            scheduled = time.perf_counter()
+        pool.submit(send, req, scheduled)
+duration = time.perf_counter() - started
+
+latencies.sort()
+print("sent {} calls in {:.3f}s: {:.1f} calls/s, {} errors".format(len(latencies), duration, len(latencies) / duration if duration > 0 else 0.0, errors[0]))
+print("latency ms: p50={:.3f} p90={:.3f} p99={:.3f} max={:.3f}".format(
+    percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000, percentile(latencies, 99) * 1000, (latencies[-1] if latencies else 0.0) * 1000))
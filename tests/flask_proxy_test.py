@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# Scripted checks of the flask proxy (fork handling, replicas, disk cache, slow log digests),
+# run without nodeos or evm-rpc: upstream calls are answered from chains built here.
+#
+#   python3 flask_proxy_test.py
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import flask_proxy
+
+def make_chain(prefix, start, end, parent_hash):
+    blocks = []
+    for number in range(start, end + 1):
+        block = {"number": hex(number), "hash": "0x%s%062x" % (prefix, number), "parentHash": parent_hash}
+        blocks.append(block)
+        parent_hash = block["hash"]
+    return blocks
+
+class ScriptedChain:
+    """Answers the evm-rpc calls of HeadTracker from a set of blocks and a chosen latest block."""
+
+    def __init__(self, blocks):
+        self.by_hash = {}
+        self.latest = None
+        self.add(blocks)
+
+    def add(self, blocks):
+        for block in blocks:
+            self.by_hash[block["hash"]] = block
+        self.latest = blocks[-1]
+
+    def rpc_call(self, endpoint, method, params):
+        if method == "eth_getBlockByNumber" and params[0] == "latest":
+            return {"result": self.latest}
+        if method == "eth_getBlockByHash":
+            return {"result": self.by_hash.get(params[0])}
+        raise AssertionError("unexpected call %s%s" % (method, params))
+
+class ForkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.original_rpc_call = flask_proxy.rpc_call
+        self.a = make_chain("aa", 0, 102, "0x" + "0" * 64)
+        self.chain = ScriptedChain(self.a[:99])
+        flask_proxy.rpc_call = self.chain.rpc_call
+        self.tracker = flask_proxy.HeadTracker("http://replica", 0.5, 1000)
+        self.events = []
+        self.tracker.add_listener(lambda block, previous, forked: self.events.append((int(block["number"], 16), forked)))
+        self.tracker.poll()
+        self.chain.add(self.a[99:101])
+        self.tracker.poll()
+        self.events.clear()
+        self.lib = flask_proxy.LibTracker("http://nodeos", 0, 1)
+        self.cache = flask_proxy.ResponseCache(100, 60, 100, self.lib, self.tracker)
+        self.tracker.add_listener(self.cache.on_new_head)
+
+    def tearDown(self):
+        flask_proxy.rpc_call = self.original_rpc_call
+
+    def fork_from(self, number, end):
+        # a competing branch "bb" on top of block number of chain a
+        return make_chain("bb", number + 1, end, self.a[number]["hash"])
+
+    def test_head_moves_forward(self):
+        self.chain.add(self.a[101:103])
+        self.tracker.poll()
+        self.assertEqual(self.events, [(102, False)])
+        self.assertEqual(self.tracker.hash_at(101), self.a[101]["hash"])
+
+    def test_head_jump_onto_fork(self):
+        b = self.fork_from(98, 102)
+        self.chain.add(b)
+        self.tracker.poll()
+        self.assertEqual(self.events[-1], (102, True))
+        for block in b:
+            self.assertEqual(self.tracker.hash_at(int(block["number"], 16)), block["hash"])
+        self.assertEqual(self.tracker.hash_at(98), self.a[98]["hash"])
+
+    def test_same_height_reorg(self):
+        b = self.fork_from(99, 100)
+        self.chain.add(b)
+        self.tracker.poll()
+        self.assertEqual(self.events[-1], (100, True))
+        self.assertEqual(self.tracker.hash_at(100), b[-1]["hash"])
+
+    def test_replica_behind_on_same_chain(self):
+        self.chain.latest = self.a[99]
+        self.tracker.poll()
+        self.assertEqual(self.events, [])
+        self.assertEqual(self.tracker.number(), 100)
+
+    def test_fork_clears_reversible_cache(self):
+        self.cache.put("k", {"n": 100}, 100)
+        self.chain.add(self.fork_from(99, 101))
+        self.tracker.poll()
+        self.assertIs(self.cache.get("k"), flask_proxy.ResponseCache.MISS)
+
+    def test_promotion_checks_canonical_hash(self):
+        self.cache.put("replaced", {"n": 100}, 100)
+        self.cache.put("kept", {"n": 99}, 99)
+        # the fork is swapped in without the listener seeing it, as between two polls
+        self.tracker.hashes[100] = "0x" + "bb" * 32
+        self.lib.lib = 100
+        self.assertIs(self.cache.get("replaced"), flask_proxy.ResponseCache.MISS)
+        self.assertEqual(self.cache.get("kept")[0], b'{"n":99}')
+        self.assertIn("kept", self.cache.final)
+
+    def full_block(self, block):
+        return dict(block, transactions=[{"hash": "0x%s" % block["hash"][-8:]}])
+
+    def test_block_index_drops_unlinked_blocks(self):
+        index = flask_proxy.BlockIndex(10, self.lib, self.tracker)
+        index.add(self.full_block(self.a[99]))
+        index.add(self.full_block(self.a[100]))
+        # a block the tracker has not seen yet, whose parent is not the indexed 100
+        index.add(self.full_block(make_chain("bb", 101, 101, "0x" + "cc" * 32)[0]))
+        self.assertEqual(list(index.blocks), [101])
+        # the tracker knows 100 on chain a, a block 100 of another branch is not indexed
+        index.add(self.full_block(self.fork_from(99, 100)[0]))
+        self.assertEqual(list(index.blocks), [101])
+
+    def test_disk_cache_of_other_chain_is_emptied(self):
+        path = os.path.join(tempfile.mkdtemp(), "cache.db")
+        genesis = {"chain": "0x4571"}
+        flask_proxy.rpc_call = lambda endpoint, method, params: {"result": genesis["chain"] if method == "eth_chainId" else self.a[0]}
+        disk = flask_proxy.DiskCache(path, 1 << 20)
+        disk.verify()
+        disk.write("put", "k", (b"1", 'W/"1"'), 0)
+        disk.db.commit()
+        genesis["chain"] = "0x4572"
+        disk = flask_proxy.DiskCache(path, 1 << 20)
+        self.assertEqual(len(disk.sizes), 1)
+        disk.verify()
+        self.assertEqual(disk.sizes, {})
+        self.assertIs(disk.get("k"), flask_proxy.ResponseCache.MISS)
+
+class ReplicaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.replicas = flask_proxy.ReadReplicas(["a", "b", "c"], 1, 2, flask_proxy.LibTracker("http://nodeos", 0, 1))
+        self.replicas.heads.update(a=100, b=90, c=110)
+        self.replicas.lagging = {"c"}
+
+    def test_pinned_calls_go_to_replicas_with_the_block(self):
+        self.assertEqual({self.replicas.pick(95) for i in range(4)}, {"a", "c"})
+        self.assertEqual({self.replicas.pick(105) for i in range(4)}, {"c"})
+
+    def test_latest_calls_skip_lagging_replicas(self):
+        self.assertEqual({self.replicas.pick() for i in range(4)}, {"a", "b"})
+        self.assertEqual(self.replicas.freshest(), "a")
+
+class DigestTest(unittest.TestCase):
+
+    def test_odd_params(self):
+        for params in (None, 5, "x", {"a": 1}, [None], [[1]], [{"fromBlock": 5, "address": 7}]):
+            for method in ("eth_getLogs", "eth_call", "eth_getBalance"):
+                flask_proxy.param_digest(method, params, 100)
+
+    def test_log_range(self):
+        digest = flask_proxy.param_digest("eth_getLogs", [{"fromBlock": "0x10", "address": ["0x1", "0x2"]}], 0x1f)
+        self.assertEqual(digest, {"fromBlock": 16, "toBlock": 31, "span": 16, "addresses": 2, "topics": 0})
+
+class LibTest(unittest.TestCase):
+
+    def lib_for(self, timestamp):
+        lib = flask_proxy.LibTracker("http://nodeos", flask_proxy.convert_to_epoch("2023-01-01T00:00:00.000"), 1)
+        replies = {"/v1/chain/get_info": {"head_block_time": timestamp, "last_irreversible_block_num": 7},
+                   "/v1/chain/get_block": {"timestamp": timestamp}}
+        lib.nodeos_call = lambda path, body: replies[path]
+        lib.poll()
+        return lib.lib
+
+    def test_last_block_of_second(self):
+        self.assertEqual(self.lib_for("2023-01-01T00:00:10.500"), 11)
+
+    def test_first_block_of_second(self):
+        # the second half of EVM block 11 can still fork away
+        self.assertEqual(self.lib_for("2023-01-01T00:00:10.000"), 10)
+
+if __name__ == "__main__":
+    unittest.main()